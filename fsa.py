@@ -10,11 +10,14 @@ and format (to stdout).
 Usage:
     $ python fsa.py ROOT_PATH                   - File(s) or path to audit.
                     [--recursive]               - Recursively walk directory tree.
-                    [--json]                    - Output in JSON format.
+                    [--json]                    - Output in JSON format (.gz/.xz/.lzma to compress).
+                    [--base ARCHIVE]            - Store JSON output as changes against base archive.
                     [--csv]                     - Output in CSV format.
                     [--algorithm ALGORITHM]     - File hash algorithm (see below).
                     [--string FORMAT_STRING]    - Output str.format template (see below).
                     [--ignore FILE_NAME_FILTER] - Ignore fnmatch pattern (can specify multiple).
+                    [--jobs JOBS]               - Hashing threads per non-rotational device (or diff processes).
+                    [--device-jobs PATH=JOBS]   - Hashing threads for device holding PATH (can specify multiple).
 
     FORMAT_STRING defines template for output using the following keywords:
         {name}  - File name (no path)
@@ -47,6 +50,16 @@ Note:
     * Two CSV output files can be effectively compared using Beyond Compare,
       (https://www.scootersoftware.com) or other diff tools.
     * Ignores empty folders.
+    * Archives ending in .gz, .xz or .lzma are compressed. Delta archives
+      (--base) may be chained, and are loaded transparently by --diff. Use
+      --compact ARCHIVE OUTPUT to convert a delta chain to a full archive.
+      Files differing only in atime are stored as a compact path/atime map.
+    * Each root path is walked in its own thread, and files on different
+      devices are hashed concurrently. Rotational disks
+      (see /sys/block) use a single thread reading in inode order, unless
+      overridden with --device-jobs. Output order is unaffected.
+    * With --diff, --jobs JOBS splits files into shards by path hash and diffs
+      them in JOBS processes. The report is identical to a serial diff.
 """
 
 from __future__ import print_function
@@ -65,10 +78,28 @@ import hashlib
 import json
 import argparse
 import csv
+import gzip
+import pickle
+import shutil
+import tempfile
+import zlib
 from fnmatch import fnmatch
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import threading
+from multiprocessing import Pool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+
+try:
+    import lzma
+except ImportError:
+    lzma = None  # Python 2 - no lzma in the standard library.
 
 BLOCK_SIZE = 128*1024*1024 # 128MiB block size
+SCHEDULE_WINDOW = 256 # Max files waiting for a hashing thread, per device
 HASH_FN = hashlib.sha256()
 
 class FileMeta(object):
@@ -297,14 +328,35 @@ class FileMetaCollection(object):
             csv_writer.writerow(FileMeta.KEYS)
             csv_writer.writerows((x.to_list() for x in self.meta_list))
 
-    def to_json(self, path):
+    def to_json(self, path, base=None):
         """Save FileMeta collection to JSON file.
 
+        If a base archive is specified, only the records added, removed or
+        changed relative to that archive are saved (see delta_archive()).
+        A full archive is saved instead if paths are not unique. Output is
+        compressed if path ends in .gz, .xz or .lzma.
+
         Args:
             path: Output JSON file path
+            base: Base archive path (full or delta) to store changes against
         """
-        with open(path, "w") as json_file:
-            json.dump([x.to_dict() for x in self.meta_list], json_file)
+        records = [x.to_dict() for x in self.meta_list]
+
+        if base:
+            chain = []
+            base_records = read_archive(base, chain)
+
+            if os.path.realpath(path) in chain:
+                raise ValueError("Delta archive cannot replace its base: " +
+                                 path)
+
+            delta = delta_archive(base_records, records,
+                                  os.path.relpath(base, os.path.dirname(
+                                      os.path.abspath(path))))
+            if delta:
+                records = delta
+
+        write_archive(path, records)
 
     def from_iterable(self, iterable):
         """Load MetaFiles from MetaFile iterable.
@@ -318,15 +370,14 @@ class FileMetaCollection(object):
     def from_json_file(self, path):
         """Load MetaFiles from Json file.
 
+        Delta and compressed archives are resolved transparently.
+
         Args:
             path: JSON File path
         """
-        with open(path, "r") as meta_file:
-            raw_meta_data = json.load(meta_file)
-
-            for raw_meta in raw_meta_data:
-                meta = FileMeta(from_dict=raw_meta)
-                self.add(meta)
+        for raw_meta in read_archive(path):
+            meta = FileMeta(from_dict=raw_meta)
+            self.add(meta)
 
     def get_meta_list(self):
         """Get list of all FileMeta objects in this FileMetaCollection."""
@@ -356,6 +407,185 @@ class FileMetaCollection(object):
         return self.meta_indexed[key].get(value, None)
 
 
+def open_archive(path, mode="rb"):
+    """Open archive file, compressed according to its file extension.
+
+    Files ending in .gz are gzip compressed, .xz are xz compressed, .lzma are
+    compressed in the legacy lzma format, and any other file is treated as
+    plain JSON.
+
+    Args:
+        path: Archive file path
+        mode: Binary file mode ("rb" or "wb")
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".gz":
+        return gzip.open(path, mode)
+
+    if extension in (".xz", ".lzma"):
+        if lzma is None:
+            raise ValueError("lzma compression is not available: " + path)
+
+        lzma_format = lzma.FORMAT_ALONE if extension == ".lzma" else \
+            lzma.FORMAT_XZ
+        return lzma.open(path, mode, format=lzma_format)
+
+    return open(path, mode)
+
+
+def write_archive(path, archive):
+    """Save full (list) or delta (dict) archive to specified path.
+
+    Args:
+        path: Output archive path (see open_archive())
+        archive: List of FileMeta dicts, or delta archive dict
+    """
+    with open_archive(path, "wb") as archive_file:
+        archive_file.write(json.dumps(archive).encode("utf-8"))
+
+
+def read_archive(path, chain=None):
+    """Load list of FileMeta dicts from full or delta archive.
+
+    A full archive is a JSON list of FileMeta dicts. A delta archive is a JSON
+    object referencing a base archive (itself full or delta), and is resolved
+    by applying its changes to the records loaded from that base.
+
+    Args:
+        path: Archive file path (see open_archive())
+        chain: Optional list, extended with the real path of every archive
+               in the delta chain (path first)
+    """
+    chain = [] if chain is None else chain
+    real_path = os.path.realpath(path)
+
+    if real_path in chain:
+        raise ValueError("Delta archive chain loops back to " + path)
+
+    chain.append(real_path)
+
+    with open_archive(path, "rb") as archive_file:
+        archive = json.loads(archive_file.read().decode("utf-8"))
+
+    if not isinstance(archive, dict):
+        return archive
+
+    base_path = os.path.join(os.path.dirname(path), archive["base"])
+    base = read_archive(base_path, chain)
+
+    return apply_delta(base, archive)
+
+
+def delta_archive(base, records, base_path):
+    """Build delta archive of records relative to base records.
+
+    Records are matched on "path". Records only found in base are stored as
+    removed paths, records only found in records are stored as added, and
+    records present in both but with differing values are stored as changed.
+    Auditing reads every file, so records differing only in atime are common;
+    these are stored compactly in "atime" as {path: atime} instead.
+
+    The position of each added record is stored in "added_index". If the
+    records common to both archives have been reordered, the full ordered
+    path list is stored in "order" instead. Either way apply_delta() rebuilds
+    records in their original order.
+
+    Returns None if paths in base or records are not unique, as such archives
+    cannot be expressed as a delta.
+
+    Example:
+        {"base": "host-1.json",
+         "added": [{"path": "new.txt", ...}],
+         "added_index": [4],
+         "changed": [{"path": "edited.txt", ...}],
+         "atime": {"read.txt": 1508223225.1},
+         "removed": ["deleted.txt"]}
+
+    Args:
+        base: List of FileMeta dicts in base archive
+        records: List of FileMeta dicts to store
+        base_path: Base archive path, relative to the delta archive
+    """
+    base_index = OrderedDict((r["path"], r) for r in base)
+    record_paths = [r["path"] for r in records]
+    record_path_set = set(record_paths)
+
+    if len(base_index) != len(base) or \
+            len(record_path_set) != len(record_paths):
+        return None
+
+    delta = OrderedDict([("base", base_path),
+                         ("added", []),
+                         ("added_index", []),
+                         ("changed", []),
+                         ("atime", OrderedDict()),
+                         ("removed", [p for p in base_index
+                                      if p not in record_path_set])])
+
+    for index, record in enumerate(records):
+        base_record = base_index.get(record["path"])
+
+        if base_record is None:
+            delta["added"].append(record)
+            delta["added_index"].append(index)
+        elif base_record != record:
+            if dict(base_record, atime=record["atime"]) == record:
+                delta["atime"][record["path"]] = record["atime"]
+            else:
+                delta["changed"].append(record)
+
+    kept_base_order = [p for p in base_index if p in record_path_set]
+    kept_order = [p for p in record_paths if p in base_index]
+
+    if kept_base_order != kept_order:
+        del delta["added_index"]
+        delta["order"] = record_paths
+
+    return delta
+
+
+def apply_delta(base, delta):
+    """Apply delta archive to base records, returning full list of records.
+
+    Changed records replace the base record, atime only changes are applied
+    to a copy of the base record, and added records are inserted at their
+    recorded positions (see delta_archive()).
+
+    Args:
+        base: List of FileMeta dicts in base archive
+        delta: Delta archive dict (see delta_archive())
+    """
+    records = OrderedDict((r["path"], r) for r in base)
+
+    for path in delta["removed"]:
+        records.pop(path, None)
+
+    for record in delta["changed"]:
+        records[record["path"]] = record
+
+    for path, atime in delta.get("atime", {}).items():
+        records[path] = dict(records[path], atime=atime)
+
+    if "order" in delta:
+        for record in delta["added"]:
+            records[record["path"]] = record
+
+        return [records[p] for p in delta["order"]]
+
+    # Merge added records into the kept base records by position.
+    kept = iter(records.values())
+    result = []
+
+    for index, record in zip(delta["added_index"], delta["added"]):
+        while len(result) < index:
+            result.append(next(kept))
+        result.append(record)
+
+    result.extend(kept)
+    return result
+
+
 def get_key_value_superset(file_meta_collections, primary_key):
     """Get key value superset from a list of FileMetaCollection's.
 
@@ -465,6 +695,170 @@ def group_diff(interesting_keys, meta_files):
     return result
 
 
+def summarize_diff(diffs):
+    """Reduce group_diff() results to diff group integers only.
+
+    Returns one (KEY_GROUPS_TUPLE, SUMMARY_GROUP) tuple per archive, or None
+    where the file is absent. KEY_GROUPS_TUPLE holds the diff group integers
+    in interesting_keys order.
+
+    Args:
+        diffs: List of group_diff() results
+    """
+    return [(tuple(diff[1].values()), diff[2]) if diff else None
+            for diff in diffs]
+
+
+def diff_archives(archive_paths, interesting_keys, path_key="path"):
+    """Diff generator comparing each file across specified archives.
+
+    Yields (file_key, diffs) for every primary key value found in any of the
+    archives, in get_key_value_superset() order. Diffs are as returned by
+    summarize_diff(), one per archive.
+
+    Args:
+        archive_paths: List of archive file paths (full or delta)
+        interesting_keys: List of key strings to compare (see group_diff())
+        path_key: Primary key used to match files across archives
+    """
+    file_meta_collections = [
+        FileMetaCollection(path_key, name=path, from_json_file=path)
+        for path in archive_paths]
+
+    primary_key_values = get_key_value_superset(file_meta_collections,
+                                                path_key)
+
+    for file_key in primary_key_values:
+
+        # Obtain meta data for different version of the file
+        meta_list = [
+            m.get_meta(path_key, file_key) for m in file_meta_collections]
+
+        yield file_key, summarize_diff(group_diff(interesting_keys, meta_list))
+
+
+def key_shard(key_value, shard_count):
+    """Return shard number for the specified primary key value.
+
+    Uses crc32 rather than hash() so that the shard does not depend on hash
+    randomization. The key is hashed in its (ASCII) JSON form, so that paths
+    which are not valid UTF-8 (surrogate escaped by os.walk) are accepted.
+
+    Args:
+        key_value: Primary key value such as a file path
+        shard_count: Total number of shards
+    """
+    return (zlib.crc32(json.dumps(key_value).encode("ascii"))
+            & 0xffffffff) % shard_count
+
+
+def _shard_file(shard_dir, shard, archive_index):
+    """Return path of the file holding one archive's records for a shard."""
+    return os.path.join(shard_dir, "{}-{}.pickle".format(shard, archive_index))
+
+
+def _split_archive(split_args):
+    """Split a single archive's records into per-shard files.
+
+    Worker for diff_archives_sharded(). Returns the archive's primary key
+    values, in order of first appearance.
+    """
+    archive_index, path, path_key, shard_count, shard_dir = split_args
+
+    # shard_records = [SHARD] = [RAW_META, ...]
+    shard_records = [[] for _ in range(shard_count)]
+
+    # Using OrderedDict as 'ordered set', see get_key_value_superset().
+    file_keys = OrderedDict()
+
+    for raw_meta in read_archive(path):
+        file_key = raw_meta[path_key]
+        file_keys.setdefault(file_key, None)
+        shard_records[key_shard(file_key, shard_count)].append(raw_meta)
+
+    for shard, records in enumerate(shard_records):
+        with open(_shard_file(shard_dir, shard, archive_index), "wb") as f:
+            pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+
+    return list(file_keys)
+
+
+def _diff_shard(shard_args):
+    """Diff the primary key values belonging to a single shard.
+
+    Worker for diff_archives_sharded(). Loads only the shard's records, one
+    file per archive (see _split_archive()), and returns
+    {file_key: summarize_diff() result}.
+    """
+    shard, archive_count, shard_dir, interesting_keys, path_key = shard_args
+
+    file_meta_collections = []
+    for archive_index in range(archive_count):
+        with open(_shard_file(shard_dir, shard, archive_index), "rb") as f:
+            records = pickle.load(f)
+
+        file_meta_collections.append(FileMetaCollection(
+            path_key, from_iterable=(
+                FileMeta(from_dict=raw_meta) for raw_meta in records)))
+
+    diffs = {}
+    for file_key in get_key_value_superset(file_meta_collections, path_key):
+        meta_list = [
+            m.get_meta(path_key, file_key) for m in file_meta_collections]
+
+        diffs[file_key] = summarize_diff(group_diff(interesting_keys,
+                                                    meta_list))
+
+    return diffs
+
+
+def diff_archives_sharded(archive_paths, interesting_keys, path_key="path",
+                          jobs=1):
+    """Diff generator splitting the work across a pool of processes.
+
+    Equivalent to diff_archives(), but done in two parallel passes. First
+    each archive is read by a worker process and split into temporary
+    per-shard files (see key_shard()). Then each shard is diffed by a worker
+    which loads only that shard's records. Only primary key values and diff
+    group integers are returned to this process. As diff groups are numbered
+    per file, output matches diff_archives() exactly.
+
+    Args:
+        archive_paths: List of archive file paths (full or delta)
+        interesting_keys: List of key strings to compare (see group_diff())
+        path_key: Primary key used to match files across archives
+        jobs: Number of worker processes (and shards)
+    """
+    shard_dir = tempfile.mkdtemp(prefix="fsa-")
+    pool = Pool(jobs)
+
+    try:
+        archive_keys = pool.map(_split_archive, [
+            (archive_index, path, path_key, jobs, shard_dir)
+            for archive_index, path in enumerate(archive_paths)])
+
+        # Using OrderedDict as 'ordered set', see get_key_value_superset().
+        primary_key_values = OrderedDict()
+        for file_keys in archive_keys:
+            primary_key_values.update((k, None) for k in file_keys)
+        del archive_keys
+
+        diffs = {}
+        for shard_diffs in pool.imap_unordered(_diff_shard, [
+                (shard, len(archive_paths), shard_dir, interesting_keys,
+                 path_key)
+                for shard in range(jobs)]):
+            diffs.update(shard_diffs)
+
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    for file_key in primary_key_values:
+        yield file_key, diffs.pop(file_key)
+
+
 def hash_file(path, hash_algorithm=HASH_FN):
     """Return hash of specified file.
 
@@ -506,25 +900,21 @@ def ignore_file(ignore_path, ignore_files):
     return False
 
 
-def walk_path(path, recursive=False, hash_algorithm=HASH_FN, ignore_files=None):
-    """FileMeta generator using os.walk to identify input files
+def walk_file_paths(path, recursive=False, ignore_files=None):
+    """File path generator using os.walk to identify input files
 
-    Yields single FileMeta object based on (optionally recursive) traversal of
-    directory tree starting at specified root path. Traverses top-down.
+    Yields file paths based on (optionally recursive) traversal of directory
+    tree starting at specified root path. Traverses top-down.
 
     Args:
         path: Root path for meta-data calculation
         recursive: True if full directory tree should be traversed
-        hash_algorithm: hashlib Algorithm such as hashlib.sha1()
         ignore_files: List of file patterns to ignore (tested with fnmatch)
     """
 
     if not os.path.isdir(path):
         if not ignore_file(path, ignore_files):
-            try:
-                yield FileMeta(path, hash_algorithm)
-            except IOError:
-                yield None
+            yield path
     else:
         for root, dirs, files in os.walk(path):
             for file_name in files:
@@ -533,14 +923,251 @@ def walk_path(path, recursive=False, hash_algorithm=HASH_FN, ignore_files=None):
                 if ignore_file(file_path, ignore_files):
                     continue
 
-                try:
-                    yield FileMeta(file_path, hash_algorithm)
-                except IOError:
-                    yield None
+                yield file_path
 
             if not recursive:
                 break
 
+
+def device_is_rotational(device):
+    """Check if the specified device is a rotational (spinning) disk.
+
+    Looks up the block device in /sys/dev/block by major:minor number and reads
+    its queue/rotational flag. Partitions carry no queue of their own, so the
+    parent disk is consulted instead. Devices without a sysfs entry (network
+    mounts, tmpfs, non-linux hosts) are reported as non-rotational.
+
+    Args:
+        device: Device number (os.stat st_dev)
+    """
+    if not hasattr(os, "major"):
+        return False
+
+    sys_path = os.path.realpath("/sys/dev/block/{}:{}".format(
+        os.major(device), os.minor(device)))
+
+    for block_path in (sys_path, os.path.dirname(sys_path)):
+        try:
+            with open(os.path.join(block_path, "queue", "rotational")) as flag:
+                return flag.read().strip() == "1"
+        except IOError:
+            continue
+
+    return False
+
+
+_PENDING = object()  # Placeholder for a FileMeta not yet hashed.
+
+
+def _meta_or_none(file_path, hash_algorithm):
+    """Return FileMeta for specified file, or None on read error."""
+    try:
+        return FileMeta(file_path, hash_algorithm)
+    except IOError:
+        return None
+
+
+def schedule_meta(file_path_iterables, hash_algorithm=HASH_FN, jobs=1,
+                  device_jobs=None, window=SCHEDULE_WINDOW):
+    """FileMeta generator hashing files on different devices concurrently
+
+    Each iterable of file paths (typically one per root path) is walked in its
+    own thread, which routes files by device (os.stat st_dev) to that device's
+    pool of hashing threads. All devices are therefore kept busy from the
+    start, and a slow disk does not leave the others idle. Rotational devices
+    default to a single hashing thread, and receive files in batches sorted by
+    inode, as an approximation of on-disk offset to limit seeking.
+
+    At most window files per device wait for a hashing thread; walking pauses
+    until the device catches up. Hashed results are buffered until their turn
+    to be yielded.
+
+    FileMeta objects (or None on read error) are yielded in input order: each
+    iterable in turn, in the order of its file paths.
+
+    Args:
+        file_path_iterables: List of iterables of file paths to audit
+        hash_algorithm: hashlib Algorithm such as hashlib.sha1()
+        jobs: Default number of hashing threads per non-rotational device
+        device_jobs: Dict of {st_dev: thread_count} overriding the defaults
+        window: Max files per device waiting for a hashing thread
+    """
+    device_jobs = device_jobs or {}
+    batch_size = max(1, window // 2)
+
+    # Guards all state below. Notified whenever a slot is added or filled,
+    # or a walker finishes.
+    condition = threading.Condition()
+
+    # devices = {key = ST_DEV, val = (QUEUE, ROTATIONAL)}
+    devices = {}
+
+    # Per iterable, slots not yet yielded in input order. A slot is a one
+    # item list holding _PENDING until hashed.
+    slots = [deque() for _ in file_path_iterables]
+    walked = [False for _ in file_path_iterables]
+    errors = []
+    stop = threading.Event()
+    threads = []
+
+    def start_thread(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    def hash_files(file_queue):
+        while not stop.is_set():
+            try:
+                slot, file_path = file_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            try:
+                meta = _meta_or_none(file_path, hash_algorithm)
+            except Exception as error:
+                with condition:
+                    errors.append(error)
+                    condition.notify_all()
+                return
+
+            with condition:
+                slot[0] = meta
+                condition.notify_all()
+
+    def device_queue(device):
+        with condition:
+            if device not in devices:
+                rotational = (device is not None and
+                              device_is_rotational(device))
+                devices[device] = (queue.Queue(window), rotational)
+
+                for _ in range(device_jobs.get(
+                        device, 1 if rotational else jobs)):
+                    start_thread(hash_files, devices[device][0])
+
+            return devices[device]
+
+    def submit(file_queue, files):
+        for inode, slot, file_path in sorted(files, key=lambda f: f[0]):
+            while not stop.is_set():
+                try:
+                    file_queue.put((slot, file_path), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def walk_files(index, file_paths):
+        # batches = {key = ST_DEV, val = [(ST_INO, SLOT, FILE_PATH), ...]}
+        batches = {}
+
+        try:
+            for file_path in file_paths:
+                if stop.is_set():
+                    return
+
+                try:
+                    file_stat = os.stat(file_path)
+                    device, inode = file_stat.st_dev, file_stat.st_ino
+                except (IOError, OSError):
+                    # Let the hashing thread report the read error.
+                    device, inode = None, 0
+
+                file_queue, rotational = device_queue(device)
+                slot = [_PENDING]
+
+                with condition:
+                    slots[index].append(slot)
+                    condition.notify_all()
+
+                batch = batches.setdefault(device, [])
+                batch.append((inode, slot, file_path))
+
+                if not rotational or len(batch) >= batch_size:
+                    submit(file_queue, batches.pop(device))
+
+            for device, batch in batches.items():
+                submit(devices[device][0], batch)
+
+        except Exception as error:
+            with condition:
+                errors.append(error)
+                condition.notify_all()
+
+        finally:
+            with condition:
+                walked[index] = True
+                condition.notify_all()
+
+    for index, file_paths in enumerate(file_path_iterables):
+        start_thread(walk_files, index, file_paths)
+
+    try:
+        for index in range(len(file_path_iterables)):
+            while True:
+                with condition:
+                    while not errors:
+                        if slots[index] and slots[index][0][0] is not _PENDING:
+                            meta = slots[index].popleft()[0]
+                            break
+                        if not slots[index] and walked[index]:
+                            meta = _PENDING
+                            break
+                        condition.wait()
+                    else:
+                        raise errors[0]
+
+                if meta is _PENDING:
+                    break
+
+                yield meta
+
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def device_jobs_arg(value):
+    """Parse "PATH=JOBS" argument into (st_dev, JOBS) for the device of PATH.
+
+    Args:
+        value: Command line argument string
+    """
+    device_path, sep, job_count = value.rpartition("=")
+    if not sep or not device_path:
+        raise argparse.ArgumentTypeError(
+            "expected PATH=JOBS, got {!r}".format(value))
+
+    job_count = positive_int_arg(job_count)
+
+    try:
+        device = os.stat(device_path).st_dev
+    except (IOError, OSError) as error:
+        raise argparse.ArgumentTypeError(
+            "cannot stat {!r}: {}".format(device_path, error.strerror))
+
+    return device, job_count
+
+
+def positive_int_arg(value):
+    """Parse integer argument, rejecting values below 1.
+
+    Args:
+        value: Command line argument string
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "expected a positive integer, got {!r}".format(value))
+
+    return number
+
+
 def cmd_walk(args):
     """Analyse files on file system."""
     hash_algorithm_map = {"md5": hashlib.md5(),
@@ -557,36 +1184,40 @@ def cmd_walk(args):
 
     multi_path = len(args.path) > 1
 
+    device_jobs = dict(args.device_jobs or [])
+
     meta_file_collection = None
     if bool(args.csv) | bool(args.json):
         meta_file_collection = FileMetaCollection(["path"])
 
-    for file_path in args.path:
-        if os.path.isdir(file_path) and multi_path and not args.recursive:
-            continue
+    file_path_iterables = [
+        walk_file_paths(root_path, recursive=args.recursive,
+                        ignore_files=args.ignore)
+        for root_path in args.path
+        if not (os.path.isdir(root_path) and multi_path and not args.recursive)]
 
-        for file_meta in walk_path(file_path, recursive=args.recursive,
+    for file_meta in schedule_meta(file_path_iterables,
                                    hash_algorithm=hash_algorithm,
-                                   ignore_files=args.ignore):
+                                   jobs=args.jobs, device_jobs=device_jobs):
 
-            if not file_meta:
-                print("File read error".format(file_path))
-                continue
+        if not file_meta:
+            print("File read error")
+            continue
 
-            if args.string:
-                print(file_meta.to_string(fmt=args.string))
-            else:
-                print(file_meta.path)
+        if args.string:
+            print(file_meta.to_string(fmt=args.string))
+        else:
+            print(file_meta.path)
 
-            if meta_file_collection:
-                meta_file_collection.add(file_meta)
+        if meta_file_collection:
+            meta_file_collection.add(file_meta)
 
     if meta_file_collection:
         if args.csv:
             meta_file_collection.to_csv(args.csv)
 
         if args.json:
-            meta_file_collection.to_json(args.json)
+            meta_file_collection.to_json(args.json, base=args.base)
 
 
 def cmd_diff(args):
@@ -600,17 +1231,11 @@ def cmd_diff(args):
 
     interesting_keys = args.diffkeys if args.diffkeys else ["hash"]
 
-    file_meta_collections = []
-
-    # Input analysis archives
-    for path in args.diff:
-        file_meta_collection = FileMetaCollection(path_key, name=path,
-                                                  from_json_file=path)
-
-        file_meta_collections.append(file_meta_collection)
-
-    primary_key_values = get_key_value_superset(file_meta_collections,
-                                                path_key)
+    if args.jobs > 1:
+        file_diffs = diff_archives_sharded(args.diff, interesting_keys,
+                                           path_key, jobs=args.jobs)
+    else:
+        file_diffs = diff_archives(args.diff, interesting_keys, path_key)
 
     interesting_keys_txt = "".join(
         (key_fmt.format(k) for k in interesting_keys))
@@ -622,13 +1247,7 @@ def cmd_diff(args):
     print(column_header_txt)
 
     # For each file for which we have meta-data
-    for file_key in primary_key_values:
-
-        # Obtain meta data for different version of the file
-        meta_list = [
-            m.get_meta(path_key, file_key) for m in file_meta_collections]
-
-        diffs = group_diff(interesting_keys, meta_list)
+    for file_key, diffs in file_diffs:
 
         # For each comparison key that we are interested in
         for archive_path, diff in zip(args.diff, diffs):
@@ -643,10 +1262,10 @@ def cmd_diff(args):
                print(("Absent: " + path_fmt).format(file_and_archive))
                continue
 
-            (meta, key_groups, group) = diff
+            (key_groups, group) = diff
 
             key_group_txt = "".join((key_fmt.format(
-                g) for g in key_groups.values()))
+                g) for g in key_groups))
 
             print((path_fmt + "{}" + key_fmt).format(
                 file_and_archive, key_group_txt, group))
@@ -654,6 +1273,20 @@ def cmd_diff(args):
         print()
 
 
+def cmd_compact(args):
+    """Compact delta archive chain into a full archive."""
+    archive_path, output_path = args.compact
+
+    chain = []
+    records = read_archive(archive_path, chain)
+
+    if os.path.realpath(output_path) in chain:
+        raise SystemExit("fsa.py: error: --compact cannot overwrite an "
+                         "archive in its own chain: " + output_path)
+
+    write_archive(output_path, records)
+
+
 def main():
     """Command line interface for generating filesystem meta-data"""
     parser = argparse.ArgumentParser(
@@ -700,10 +1333,22 @@ Note:
                              "sha224, sha256, sha384, sha512).")
     parser.add_argument("-r", "--recursive", action="store_true",
                         help="Recursively walk directory tree.")
+    parser.add_argument("-j", "--jobs", type=positive_int_arg, default=1,
+                        help="Hashing threads per non-rotational device, "
+                             "or diff worker processes with --diff.")
+    parser.add_argument("--device-jobs", metavar="PATH=JOBS", action="append",
+                        type=device_jobs_arg,
+                        help="Hashing threads for the device holding PATH "
+                             "(can specify multiple).")
     parser.add_argument("--json",
                         help="Output to JSON file.")
     parser.add_argument("--csv",
                         help="Output to CSV file.")
+    parser.add_argument("--base", metavar="ARCHIVE",
+                        help="Store JSON output as changes against the "
+                             "specified base archive.")
+    parser.add_argument("--compact", nargs=2, metavar=("ARCHIVE", "OUTPUT"),
+                        help="Compact delta archive chain into full archive.")
     parser.add_argument("--diff", nargs="*",
                         help="Diff the specified archive files.")
     parser.add_argument("--diffkeys", nargs="*",
@@ -711,8 +1356,18 @@ Note:
 
     args = parser.parse_args()
 
+    if args.base:
+        if not args.json:
+            parser.error("--base requires --json")
+        if os.path.realpath(args.base) == os.path.realpath(args.json):
+            parser.error("--base and --json must be different files")
+        if not os.access(args.base, os.R_OK):
+            parser.error("cannot read base archive: " + args.base)
+
     if args.diff:
         cmd_diff(args)
+    elif args.compact:
+        cmd_compact(args)
     else:
         cmd_walk(args)
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""File system audit tool tests
+
+Usage:
+    $ python -m pytest test
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import threading
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # Python 2
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+import fsa
+
+
+class FakeStat(object):
+    """os.stat result placing "<device>/<inode>" paths on fake devices."""
+
+    def __init__(self, path):
+        device, inode = path.split("/")
+        self.st_dev = ord(device)
+        self.st_ino = int(inode)
+
+
+class ScheduleMetaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.hashed = []  # [(file_path, start, end), ...] in hashing order
+
+        def fake_meta(file_path, hash_algorithm):
+            start = time.time()
+            time.sleep(0.002)
+            with self.lock:
+                self.hashed.append((file_path, start, time.time()))
+            return file_path
+
+        patches = [mock.patch.object(fsa.os, "stat", FakeStat),
+                   mock.patch.object(fsa, "_meta_or_none", fake_meta),
+                   mock.patch.object(fsa, "device_is_rotational",
+                                     lambda device: device == ord("r"))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_devices_overlap(self):
+        roots = [["a/{}".format(i) for i in range(200)],
+                 ["b/{}".format(i) for i in range(200)]]
+
+        result = list(fsa.schedule_meta([iter(r) for r in roots], window=8))
+
+        self.assertEqual(result, roots[0] + roots[1])
+
+        a_end = max(end for path, start, end in self.hashed
+                    if path.startswith("a/"))
+        b_start = min(start for path, start, end in self.hashed
+                      if path.startswith("b/"))
+
+        # Device b must start well before device a has finished.
+        self.assertLess(b_start, a_end - 0.1)
+
+    def test_rotational_inode_order(self):
+        paths = ["r/{}".format(i) for i in (5, 3, 9, 1, 7, 2)]
+
+        result = list(fsa.schedule_meta([paths], window=100))
+
+        self.assertEqual(result, paths)
+        self.assertEqual([h[0] for h in self.hashed],
+                         sorted(paths, key=lambda p: int(p[2:])))
+
+
+
+def record(path, hash_value="0", atime=0):
+    return {"name": os.path.basename(path), "path": path, "mode": "644",
+            "uid": 0, "gid": 0, "size": 1, "atime": atime, "mtime": 0,
+            "ctime": 0, "hash": hash_value}
+
+
+class DeltaArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def tmp_path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_added_index(self):
+        base = [record("f0"), record("f1"), record("f2"), record("f3")]
+        new = [record("f9"), record("f1", "1"), record("f2"),
+               record("f5"), record("f3")]
+
+        delta = fsa.delta_archive(base, new, "base.json")
+
+        self.assertEqual(delta["added_index"], [0, 3])
+        self.assertEqual([r["path"] for r in delta["changed"]], ["f1"])
+        self.assertEqual(delta["removed"], ["f0"])
+        self.assertNotIn("order", delta)
+        self.assertEqual(fsa.apply_delta(base, delta), new)
+
+    def test_reorder(self):
+        base = [record("f0"), record("f1"), record("f2")]
+        new = [record("f2"), record("f3"), record("f0")]
+
+        delta = fsa.delta_archive(base, new, "base.json")
+
+        self.assertEqual(delta["order"], ["f2", "f3", "f0"])
+        self.assertEqual(fsa.apply_delta(base, delta), new)
+
+    def test_atime_only(self):
+        base = [record("f0"), record("f1"), record("f2")]
+        new = [record("f0", atime=5), record("f1", "1", atime=5),
+               record("f2")]
+
+        delta = fsa.delta_archive(base, new, "base.json")
+
+        self.assertEqual(delta["atime"], {"f0": 5})
+        self.assertEqual([r["path"] for r in delta["changed"]], ["f1"])
+        self.assertEqual(fsa.apply_delta(base, delta), new)
+
+    def test_compact_matches_full(self):
+        base, full = self.tmp_path("base.json"), self.tmp_path("full.json")
+        fsa.write_archive(base, [record("f1"), record("f2"), record("f4")])
+        fsa.write_archive(full, [record("f1", "1"), record("f0"),
+                                 record("f4"), record("f2", atime=3)])
+
+        collection = fsa.FileMetaCollection("path", from_json_file=full)
+        collection.to_json(self.tmp_path("delta.json.gz"), base=base)
+
+        fsa.cmd_compact(argparse.Namespace(compact=[
+            self.tmp_path("delta.json.gz"), self.tmp_path("compact.json")]))
+
+        with open(full) as full_file, \
+                open(self.tmp_path("compact.json")) as compact_file:
+            self.assertEqual(full_file.read(), compact_file.read())
+
+    def test_chain_compressed(self):
+        # Fixture archives a -> b -> c -> d, each stored against the last.
+        base = self.tmp_path("a.json")
+        shutil.copy(os.path.join(TEST_DIR, "a.json"), base)
+
+        for name, path in (("b.json", "b.json.gz"), ("c.json", "c.json.xz"),
+                           ("d.json", "d.json.lzma")):
+            collection = fsa.FileMetaCollection(
+                "path", from_json_file=os.path.join(TEST_DIR, name))
+            collection.to_json(self.tmp_path(path), base=base)
+            base = self.tmp_path(path)
+
+        chain = []
+        records = fsa.read_archive(self.tmp_path("d.json.lzma"), chain)
+
+        with open(os.path.join(TEST_DIR, "d.json")) as full_file:
+            self.assertEqual(records, json.load(full_file))
+
+        self.assertEqual(len(chain), 4)
+        with open(self.tmp_path("d.json.lzma"), "rb") as lzma_file:
+            self.assertNotEqual(lzma_file.read(6), b"\xfd7zXZ\x00")
+
+    def test_no_overwrite_chain(self):
+        base, delta = self.tmp_path("base.json"), self.tmp_path("delta.json")
+        fsa.write_archive(base, [record("f0")])
+        fsa.FileMetaCollection("path", from_iterable=[fsa.FileMeta(
+            from_dict=record("f1"))]).to_json(delta, base=base)
+
+        with self.assertRaises(SystemExit):
+            fsa.cmd_compact(argparse.Namespace(compact=[delta, base]))
+
+        collection = fsa.FileMetaCollection("path", from_json_file=delta)
+        with self.assertRaises(ValueError):
+            collection.to_json(base, base=delta)
+
+        self.assertEqual(fsa.read_archive(base), [record("f0")])
+
+
+
+class ShardedDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def diff_output(self, archive_paths, jobs, diffkeys=None):
+        output = io.StringIO()
+        with mock.patch.object(sys, "stdout", output):
+            fsa.cmd_diff(argparse.Namespace(diff=archive_paths,
+                                            diffkeys=diffkeys, jobs=jobs))
+        return output.getvalue()
+
+    def assertShardedMatchesSerial(self, archive_paths, diffkeys=None):
+        serial = self.diff_output(archive_paths, 1, diffkeys)
+
+        for jobs in (2, 3, 5):
+            self.assertEqual(
+                self.diff_output(archive_paths, jobs, diffkeys), serial)
+
+    def test_fixtures(self):
+        self.assertShardedMatchesSerial(
+            [os.path.join(TEST_DIR, n) for n in ("a.json", "b.json",
+                                                 "c.json", "d.json")],
+            diffkeys=["hash", "mtime", "size"])
+
+    def test_overlapping_archives(self):
+        # Non UTF-8 file names are surrogate escaped by os.walk.
+        paths = ["f{}".format(i) for i in range(40)] + [u"bad\udcff.txt"]
+        archive_paths = []
+
+        for index in range(4):
+            archive_path = os.path.join(self.tmp_dir, "{}.json".format(index))
+            fsa.write_archive(archive_path, [
+                record(p, str((i * index) % 3)) for i, p in enumerate(paths)
+                if (i + index) % 5][::1 if index % 2 else -1])
+            archive_paths.append(archive_path)
+
+        self.assertShardedMatchesSerial(archive_paths)
+        self.assertIn(u"bad\udcff.txt",
+                      self.diff_output(archive_paths, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()